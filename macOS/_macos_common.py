@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# Shared helpers for the macOS processors.
+# Some functions heavily burrow from munkitools code
+#
+# ATTENTION: This module has requirements:
+#   * macOS Big Sur or higher (tested on Big Sur)
+
+from __future__ import absolute_import
+
+import os, re, atexit, subprocess, json, plistlib, threading, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import cmp_to_key
+from xml.parsers.expat import ExpatError
+
+from autopkglib import ProcessorError
+
+def _version_tuple(version):
+    parts = [(int(p), '') if p.isdigit() else (-1, p) for p in re.split(r'[.\-]', version.strip()) if p]
+    while parts and parts[-1] == (0, ''):
+        parts.pop()
+    return tuple(parts)
+
+# libversion is a C extension and much faster than a pure Python comparison.
+# Fall back to packaging, or to a plain stdlib comparison if neither is
+# installed in the autopkg python.
+try:
+    from libversion import version_compare
+except ImportError:
+    try:
+        from packaging.version import InvalidVersion, Version
+    except ImportError:
+        def version_compare(a, b):
+            a, b = _version_tuple(a), _version_tuple(b)
+            return (a > b) - (a < b)
+    else:
+        def version_compare(a, b):
+            try:
+                a, b = Version(a), Version(b)
+            except InvalidVersion:
+                a, b = _version_tuple(a), _version_tuple(b)
+            return (a > b) - (a < b)
+
+__all__ = ["_MacOSInstallerBase"]
+
+# Listing the full installers queries Apple's catalog and takes a long time.
+# Keep the raw output in memory and on disk so repeated queries are cheap.
+_UPDATE_CACHE = {}
+_UPDATE_CACHE_PATH = os.path.expanduser('~/Library/Caches/autopkg-macos-updates.json')
+
+# OS versions read from SharedSupport.dmg, keyed by the installer's
+# Info.plist and dmg metadata. Saves mounting the dmg on every run.
+_INSTALLER_VERSIONS_PATH = os.path.expanduser('~/Library/Caches/autopkg-macos-installers.json')
+_INSTALLER_VERSIONS_LOCK = threading.Lock()
+
+# Seconds the parsed "hdiutil info" output is reused
+_MOUNT_CACHE_TTL = 1.0
+
+# Users of each mount point and the mount points attached by this process.
+# Shared by all processor instances and detached by a single exit hook.
+_MOUNT_REFCOUNTS = Counter()
+_OWNED_MOUNTS = set()
+_MOUNTS_LOCK = threading.Lock()
+
+# Upper bound of installer apps probed at the same time
+_MAX_PROBE_WORKERS = 4
+
+def _cached_list_full_installers(ttl=300):
+    now = time.time()
+    if _UPDATE_CACHE and now - _UPDATE_CACHE['timestamp'] < ttl:
+        return _UPDATE_CACHE['output']
+
+    try:
+        with open(_UPDATE_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+        if now - cache['timestamp'] < ttl:
+            _UPDATE_CACHE.update(cache)
+            return cache['output']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        result = subprocess.run(['/usr/sbin/softwareupdate', '--list-full-installers'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise ProcessorError(err)
+
+    # Output without any installer (e.g. an unreachable catalog) is not cached
+    cache = {'timestamp': now, 'output': result.stdout}
+    if ' Version: ' not in cache['output']:
+        return cache['output']
+
+    _UPDATE_CACHE.update(cache)
+    try:
+        os.makedirs(os.path.dirname(_UPDATE_CACHE_PATH), exist_ok=True)
+        with open(_UPDATE_CACHE_PATH, 'w') as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+    return cache['output']
+
+def _installer_versions(update=None):
+    with _INSTALLER_VERSIONS_LOCK:
+        try:
+            with open(_INSTALLER_VERSIONS_PATH, 'r') as f:
+                versions = json.load(f)
+        except (OSError, ValueError):
+            versions = {}
+        if not isinstance(versions, dict):
+            versions = {}
+
+        if update:
+            versions.update(update)
+            try:
+                os.makedirs(os.path.dirname(_INSTALLER_VERSIONS_PATH), exist_ok=True)
+                with open(_INSTALLER_VERSIONS_PATH, 'w') as f:
+                    json.dump(versions, f)
+            except OSError:
+                pass
+        return versions
+
+def _unmount_owned():
+    with _MOUNTS_LOCK:
+        mount_points = list(_OWNED_MOUNTS)
+        _OWNED_MOUNTS.clear()
+        for mount_point in mount_points:
+            _MOUNT_REFCOUNTS.pop(mount_point, None)
+
+    for mount_point in mount_points:
+        try:
+            subprocess.run(['/usr/bin/hdiutil', 'detach', mount_point, '-force'], capture_output=True, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+atexit.register(_unmount_owned)
+
+
+class _MacOSInstallerBase(object):
+    """Mixin with the installer, DMG and softwareupdate helpers shared by the macOS processors."""
+
+    def __init__(self, *args, **kwargs):
+        super(_MacOSInstallerBase, self).__init__(*args, **kwargs)
+        # (timestamp, {image-path: mount-point}) of the last "hdiutil info" call
+        self._mount_cache = None
+        # Versions of probed installer apps keyed by (path, inode, mtime)
+        self._version_cache = {}
+        self._mount_lock = threading.Lock()
+
+
+    # DMG HELER FUNCTIONS
+    def get_dmg_mount_point(self, path):
+        # Probes run in threads, so refresh and read the cache under the lock
+        with self._mount_lock:
+            if self._mount_cache is None or time.monotonic() - self._mount_cache[0] >= _MOUNT_CACHE_TTL:
+                images = plistlib.loads(subprocess.check_output(['/usr/bin/hdiutil', 'info', '-plist']))['images']
+                # Index the mount table once so lookups do not walk all images
+                mount_points = {}
+                for mount in images:
+                    for info in mount.get('system-entities', []):
+                        if 'mount-point' in info:
+                            mount_points.setdefault(mount['image-path'], info['mount-point'])
+                self._mount_cache = (time.monotonic(), mount_points)
+
+            return self._mount_cache[1].get(path)
+
+    def mount_dmg(self, path):
+        mount_point = self.get_dmg_mount_point(path)
+        if not mount_point:
+            try:
+                output = plistlib.loads(subprocess.check_output(['/usr/bin/hdiutil', 'attach', path, '-nobrowse', '-plist']))
+            except subprocess.CalledProcessError as err:
+                raise ProcessorError("Could not mount {}: {}".format(path, err))
+            mount_point = [d for d in output['system-entities'] if 'mount-point' in d][0]['mount-point']
+            with self._mount_lock:
+                self._mount_cache = None
+            # Take ownership and the first reference at once, so no unmount
+            # can detach the mount in between
+            with _MOUNTS_LOCK:
+                _OWNED_MOUNTS.add(mount_point)
+                _MOUNT_REFCOUNTS[mount_point] += 1
+            return mount_point
+
+        with _MOUNTS_LOCK:
+            _MOUNT_REFCOUNTS[mount_point] += 1
+        return mount_point
+
+    def unmount_dmg(self, path):
+        # Only detach once the last user is done, and leave foreign mounts alone
+        with _MOUNTS_LOCK:
+            if path not in _MOUNT_REFCOUNTS:
+                return ''
+            _MOUNT_REFCOUNTS[path] -= 1
+            if _MOUNT_REFCOUNTS[path] > 0:
+                return ''
+            del _MOUNT_REFCOUNTS[path]
+            if path not in _OWNED_MOUNTS:
+                return ''
+            _OWNED_MOUNTS.discard(path)
+
+        try:
+            result = subprocess.run(['/usr/bin/hdiutil', 'detach', path, '-force'], capture_output=True, text=True, check=True)
+        except subprocess.CalledProcessError as err:
+            raise ProcessorError("Could not unmount {}: {}".format(path, err))
+        finally:
+            # Drop the mount table only once the detach is done, so no probe
+            # caches the mount point while it is going away
+            with self._mount_lock:
+                self._mount_cache = None
+        return result.stdout
+
+
+    # Installer app functions
+    def get_local_installer(self, dir, version):
+        candidates = []
+        with os.scandir(dir) as it:
+            for entry in it:
+                if entry.is_dir() and os.path.exists(os.path.join(entry.path, 'Contents/Resources/startosinstall')):
+                    candidates.append(entry.path)
+        if not candidates:
+            return None
+
+        # Reading the version may mount a dmg, so probe the candidates in parallel.
+        # Results are checked in scan order so the first match stays deterministic.
+        executor = ThreadPoolExecutor(max_workers=min(len(candidates), _MAX_PROBE_WORKERS))
+        try:
+            futures = [executor.submit(self.get_os_version, item_path) for item_path in candidates]
+            for item_path, future in zip(candidates, futures):
+                if version_compare(future.result(), version) == 0:
+                    return item_path
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return None
+
+    def get_os_version(self, app_path):
+        # Remember versions so a rescan after a download only probes new apps
+        try:
+            stat = os.stat(app_path)
+        except OSError:
+            return ''
+        key = (app_path, stat.st_ino, stat.st_mtime_ns)
+        if key not in self._version_cache:
+            self._version_cache[key] = self._read_os_version(app_path)
+        return self._version_cache[key]
+
+    def _read_os_version(self, app_path):
+        installinfo_plist = os.path.join(app_path, 'Contents/SharedSupport/InstallInfo.plist')
+        if os.path.isfile(installinfo_plist):
+            try:
+                with open(installinfo_plist, 'rb') as f:
+                    return plistlib.load(f)['System Image Info']['version']
+            except (OSError, KeyError, plistlib.InvalidFileException, ExpatError):
+                return ''
+
+        sharedsupport_dmg = os.path.join(app_path, 'Contents/SharedSupport/SharedSupport.dmg')
+        if os.path.isfile(sharedsupport_dmg):
+            # The bundle version is the installer's, not the OS version, but it
+            # identifies the installer without mounting anything
+            key = self._get_installer_key(app_path, sharedsupport_dmg)
+            if key:
+                version = _installer_versions().get(key)
+                if version:
+                    return version
+
+            mountpoint = self.mount_dmg(sharedsupport_dmg)
+            if mountpoint:
+                info_plist_path = os.path.join(mountpoint, "com_apple_MobileAsset_MacSoftwareUpdate", "com_apple_MobileAsset_MacSoftwareUpdate.xml")
+                try:
+                    with open(info_plist_path, 'rb') as f:
+                        info = plistlib.load(f)
+                    version = info['Assets'][0]['OSVersion']
+                except (OSError, KeyError, IndexError, plistlib.InvalidFileException, ExpatError):
+                    return ''
+                finally:
+                    self.unmount_dmg(mountpoint)
+
+                if key:
+                    _installer_versions({key: version})
+                return version
+        return ''
+
+    def _get_installer_key(self, app_path, sharedsupport_dmg):
+        try:
+            with open(os.path.join(app_path, 'Contents/Info.plist'), 'rb') as f:
+                info = plistlib.load(f)
+            stat = os.stat(sharedsupport_dmg)
+        except (OSError, plistlib.InvalidFileException, ExpatError):
+            return None
+        return "{}:{}:{}:{}:{}".format(app_path, info.get('CFBundleShortVersionString', ''), info.get('CFBundleVersion', ''), stat.st_size, stat.st_mtime_ns)
+
+
+    # Software update functions
+    def get_update(self):
+        # Use softwareupdates list function to get all currently offered builds
+        output = _cached_list_full_installers()
+
+        # Parse the text into dicts
+        # Lines look like "* Title: macOS Big Sur, Version: 11.6.1, Size: 12439328K, Build: 20G224"
+        def parse(lines):
+            for line in lines:
+                if ' Version: ' in line:
+                    name, _, rest = line.partition(',')
+                    version, _, rest = rest.partition(',')
+                    size, _, _ = rest.partition(',')
+                    yield {
+                        "name": name.partition(':')[2].strip(),
+                        "version": version.partition(':')[2].strip(),
+                        "size": size.partition(':')[2].strip()
+                    }
+        updates = parse(output.splitlines())
+        version_key = cmp_to_key(lambda a, b: version_compare(a['version'], b['version']))
+
+        # Only build the sorted list when it is shown
+        if self.env['verbose'] >= 2:
+            updates = sorted(updates, key=version_key, reverse=True)
+            self.output("The following updates have been found: " + json.dumps(updates, indent = 4))
+
+        # Select the one with the hightes version number
+        update = max(updates, key=version_key, default=None)
+
+        # Check if the parsing was successful
+        if not update:
+            raise ProcessorError("Could not receive or parse updates")
+
+        self.output("Latest version found is {} {}".format(update['name'], update['version']))
+
+        return update
@@ -7,14 +7,18 @@
 
 from __future__ import absolute_import
 
-import os, subprocess, json, plistlib, shutil
-from distutils.version import LooseVersion
+import os, re, sys, subprocess, shutil
 
 from autopkglib import Processor, ProcessorError
 
+_processor_dir = os.path.dirname(os.path.abspath(__file__))
+if _processor_dir not in sys.path:
+    sys.path.insert(0, _processor_dir)
+from _macos_common import _MacOSInstallerBase, version_compare
+
 __all__ = ["macOSDownloader"]
 
-class macOSDownloader(Processor):
+class macOSDownloader(_MacOSInstallerBase, Processor):
     description = __doc__
 
     input_variables = {
@@ -40,70 +44,25 @@ class macOSDownloader(Processor):
     }
 
 
-    # DMG HELER FUNCTIONS
-    def get_dmg_mount_point(self, path):
-        current_mounts = plistlib.loads(subprocess.check_output(['/usr/bin/hdiutil', 'info', '-plist']))['images']
-        for mount in current_mounts:
-            if mount['image-path'] == path:
-                for info in mount['system-entities']:
-                    if 'mount-point' in info:
-                        return info['mount-point']
-        return None
-
-    def mount_dmg(self, path):
-        mount_point = self.get_dmg_mount_point(path)
-        if mount_point:
-            return mount_point
-  
-        try:
-            output = plistlib.loads(subprocess.check_output(['/usr/bin/hdiutil', 'attach', path, '-nobrowse', '-plist']))
-        except:
-            raise ProcessorError("Could not mount {}".format(path))
-
-        output = [d for d in output['system-entities'] if 'mount-point' in d][0]
-        return output['mount-point']
-
-    def unmount_dmg(self, path):
-        return subprocess.check_output(['/usr/bin/hdiutil', 'detach', path, '-force'])
-
-
-    # Installer app functions
-    def get_local_installer(self, dir, version):
-        for item in os.listdir(dir):
-            item_path = os.path.join(dir, item)
-            startosinstall_path = os.path.join(item_path, 'Contents/Resources/startosinstall')
-            if os.path.exists(startosinstall_path):
-                local_version = self.get_os_version(item_path)
-                if LooseVersion(local_version) == LooseVersion(version):
-                    return item_path
-        return None
-
-    def get_os_version(self, app_path):
-        installinfo_plist = os.path.join(app_path, 'Contents/SharedSupport/InstallInfo.plist')
-        if os.path.isfile(installinfo_plist):
-            return self.get_plist_key(installinfo_plist, 'System Image Info:version')
-
-        sharedsupport_dmg = os.path.join(app_path, 'Contents/SharedSupport/SharedSupport.dmg')
-        if os.path.isfile(sharedsupport_dmg):
-            mountpoint = self.mount_dmg(sharedsupport_dmg)
-            if mountpoint:
-                info_plist_path = os.path.join(mountpoint, "com_apple_MobileAsset_MacSoftwareUpdate", "com_apple_MobileAsset_MacSoftwareUpdate.xml")
-                try:
-                    info = plistlib.readPlist(info_plist_path)
-                    return info['Assets'][0]['OSVersion']
-                except:
-                    return ''
-                finally:
-                    self.unmount_dmg(mountpoint)
-        return ''
-
     # Softwareupdate functions
     def download_macos(self):
         # Run download process
         try:
-            subprocess.run( ['/usr/sbin/softwareupdate', '--fetch-full-installer', '--full-installer-version', self.env['version']] )
-        except Exception as err:
+            result = subprocess.run(['/usr/sbin/softwareupdate', '--fetch-full-installer', '--full-installer-version', self.env['version']], capture_output=True, text=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as err:
             raise ProcessorError(err)
+        output = result.stdout
+        if self.env['verbose'] >= 2:
+            self.output(output)
+
+        # Use the installer softwareupdate reported or the one it always creates,
+        # and only scan "/Applications" if neither has the requested version
+        match = re.search(r'/Applications/Install [^\n]*?\.app', output)
+        candidates = [match.group(0)] if match else []
+        candidates.append(os.path.join('/Applications', "Install {}.app".format(self.env['release'])))
+        for installer in candidates:
+            if os.path.isdir(installer) and version_compare(self.get_os_version(installer), self.env['version']) == 0:
+                return installer
 
         # Check if we actually successfully downloaded something
         installer = self.get_local_installer('/Applications', self.env['version'])
@@ -148,7 +107,13 @@ class macOSDownloader(Processor):
         # Copy installer into cache
         self.output("Creating copy for cache")
         os.makedirs(os.path.join(cache_path), exist_ok=True)
-        shutil.copytree(installer, installer_cache_path)
+        # On APFS "cp -c" clones the app instead of copying the data
+        try:
+            subprocess.run(['/bin/cp', '-cR', installer, installer_cache_path], capture_output=True, text=True, check=True)
+        except subprocess.CalledProcessError:
+            self.output("Could not clone installer, falling back to a regular copy")
+            shutil.rmtree(installer_cache_path, ignore_errors=True)
+            shutil.copytree(installer, installer_cache_path)
 
 
 
@@ -6,14 +6,22 @@
 
 from __future__ import absolute_import
 
-import os, subprocess, json, plistlib, shutil
-from distutils.version import LooseVersion
+import os, sys, json, time
 
-from autopkglib import Processor, ProcessorError
+from autopkglib import Processor
+
+_processor_dir = os.path.dirname(os.path.abspath(__file__))
+if _processor_dir not in sys.path:
+    sys.path.insert(0, _processor_dir)
+from _macos_common import _MacOSInstallerBase
 
 __all__ = ["macOSReleaseProvider"]
 
-class macOSReleaseProvider(Processor):
+# Last release found by softwareupdate. Reused while the matching installer is on disk.
+_RELEASE_CACHE_PATH = os.path.expanduser('~/Library/Caches/autopkg-macOSReleaseProvider.json')
+_RELEASE_CACHE_TTL = 3600
+
+class macOSReleaseProvider(_MacOSInstallerBase, Processor):
     description = __doc__
 
     input_variables = {}
@@ -26,46 +34,41 @@ class macOSReleaseProvider(Processor):
 
 
 
-    # Software update functions
-    def get_update(self):
-        # Use softwareupdates list function to get all currently offered builds
+    # Release cache functions
+    def load_release_cache(self):
         try:
-            result = subprocess.run(['/usr/sbin/softwareupdate', '--list-full-installers'], stdout=subprocess.PIPE)
-        except Exception as err:
-            raise ProcessorError(err)
-
-        # Parse the text into a list of dicts
-        update_list = []
-        for line in result.stdout.decode().split('\n'):
-            if "Version" in line:
-                update_info = [s.split(':')[1].strip() for s in line.split(',')]
-                update_list.append({
-                    "name": update_info[0],
-                    "version": update_info[1],
-                    "size": update_info[2]
-                })
-
-        # Check if the list creation was successful
-        if not update_list:
-            raise ProcessorError("Could not receive or parse updates")
-
-        # Sort this list by the version key. Highest beeing the first item
-        update_list = sorted(update_list, key=lambda k: k['version'], reverse=True)
-        # Select the one with the hightes version number
-        update = update_list[0]
-
-        if self.env['verbose'] >= 3:
-            self.output("The following updates have been found: " + json.dumps(update_list, indent = 4))
-        self.output("Latest version found is {} {}".format(update['name'], update['version']))
-
-        return update
+            with open(_RELEASE_CACHE_PATH, 'r') as f:
+                cache = json.load(f)
+            # Ignore truncated or edited files that lack one of the release fields
+            if not all(isinstance(cache.get(key), str) for key in ('name', 'version', 'size')):
+                return None
+            if time.time() - cache['checked'] < _RELEASE_CACHE_TTL:
+                return cache
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        return None
+
+    def save_release_cache(self, update):
+        cache = dict(update, checked=time.time())
+        try:
+            os.makedirs(os.path.dirname(_RELEASE_CACHE_PATH), exist_ok=True)
+            with open(_RELEASE_CACHE_PATH, 'w') as f:
+                json.dump(cache, f)
+        except OSError:
+            pass
 
 
     # Main
     def main(self):
-        # Get the list of installers from the softwareupdate binary
-        self.output("Querying software update for macOS installers")
-        update = self.get_update()
+        # Skip softwareupdate if the last found release is still installed locally
+        update = self.load_release_cache()
+        if update and self.get_local_installer('/Applications', update['version']):
+            self.output("Using recently checked release {} {}".format(update['name'], update['version']))
+        else:
+            # Get the list of installers from the softwareupdate binary
+            self.output("Querying software update for macOS installers")
+            update = self.get_update()
+            self.save_release_cache(update)
 
         self.env["version"] = update['version']
         self.env["release"] = update['name']